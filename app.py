@@ -1,8 +1,50 @@
-from flask import Flask, jsonify, request, render_template
+from flask import Flask, Response, jsonify, request, render_template
+from flask.json.provider import DefaultJSONProvider
 from random_table_manager import RandomTableManager
+from json_util import orjson
 import traceback
 
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    JSON provider backed by orjson, used by jsonify and request.json.
+    Types orjson can't handle natively go through Flask's default conversions.
+    """
+    def dumps(self, obj, **kwargs):
+        # Map the json.dumps arguments Flask passes (sort_keys, indent=2 in debug, compact separators)
+        # to orjson options; anything orjson can't express goes through the default provider
+        options = dict(kwargs)
+        option = orjson.OPT_NON_STR_KEYS
+        if options.pop('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        indent = options.pop('indent', None)
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        # orjson always writes UTF-8 and never pads separators
+        options.pop('ensure_ascii', None)
+        default = options.pop('default', self.default)
+        separators = options.pop('separators', None)
+        if options or indent not in (None, 2) or separators not in (None, (',', ':')):
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=default, option=option).decode('utf8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+if orjson:
+    app.json = OrjsonProvider(app)
+
+def json_response(payload, status=200):
+    """
+    Serializes the payload straight into a Response, skipping jsonify's argument handling.
+    Used by the draw endpoints, which are hit far more often than the others.
+    """
+    # Debug mode pretty-prints through the provider like jsonify does
+    if orjson and not app.debug:
+        option = orjson.OPT_SORT_KEYS if app.json.sort_keys else 0
+        return Response(orjson.dumps(payload, option=option), status=status, mimetype='application/json')
+    return jsonify(payload), status
+
 manager = RandomTableManager('tables')
 
 @app.route('/load', methods=['POST'])
@@ -38,12 +80,20 @@ def add_tables_json():
     else:
         return jsonify({"message": "Tables added successfully"}), 200
 
+# Serialized /table_entries responses by table name. Loading or adding a table replaces the
+# RandomTable object instead of modifying it, so a body stays valid while the table is the same object
+table_entries_cache = {}
+
 @app.route('/table_entries/<name>', methods=['GET'])
 def get_table_entries(name):
     if name not in manager.tables:
         return jsonify({"error": "Table not found"}), 404
-    entries = [{'min_roll': entry.min_roll, 'max_roll': entry.max_roll, 'target': entry.target} for entry in manager.tables[name].entries]
-    return jsonify({"table_name": name, "entries": entries}), 200
+    table = manager.tables[name]
+    cached = table_entries_cache.get(name)
+    if cached is None or cached[0] is not table:
+        entries = [{'min_roll': entry.min_roll, 'max_roll': entry.max_roll, 'target': entry.target} for entry in table.entries]
+        cached = table_entries_cache[name] = (table, app.json.dumps({"table_name": name, "entries": entries}))
+    return Response(cached[1], mimetype='application/json')
 
 @app.route('/tables', methods=['GET'])
 def get_tables():
@@ -52,17 +102,17 @@ def get_tables():
 
 @app.route('/draw/<name>', methods=['GET'])
 def draw_from_table(name):
-    if name not in manager.get_tables():
-        return jsonify({"error": "Table not found"}), 404
+    if name not in manager.tables:
+        return json_response({"error": "Table not found"}, 404)
     result = manager.draw(name)
-    return jsonify({"result": result}), 200
+    return json_response({"result": result})
 
 @app.route('/formatted_draw/<name>', methods=['GET'])
 def formatted_draw_from_table(name):
-    if name not in manager.get_tables():
-        return jsonify({"error": "Table not found"}), 404
+    if name not in manager.tables:
+        return json_response({"error": "Table not found"}, 404)
     result = manager.formatted_draw(name)
-    return jsonify({"result": result}), 200
+    return json_response({"result": result})
 
 @app.route('/')
 def index():
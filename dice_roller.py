@@ -1,6 +1,10 @@
 from lark import Lark, Transformer
 from heapq_util import max_n, min_n
+import functools
+import os
 import random
+import re
+import threading
 import argparse
 
 # Grammar for parsing dice expressions
@@ -11,11 +15,12 @@ dice_grammar = r"""
     factor : dice | constant | "(" expression ")"
 
     dice : (simpledice | dicepool) modifiers          # type int
-    simpledice: expression "d" expression
+    simpledice: (operand | dice) "d" operand
+    ?operand : constant | "(" expression ")"
     dicepool : "{" dicelist "}"  # type list
-    dicelist : dice ("," dicelist)?       # type list
+    dicelist : dice ("," dice)*       # type list
 
-    modifiers : | modifier modifiers
+    modifiers : modifier*    # type list of func
     modifier : kh | kl | dh | dl | min | max #type func: list -> list
     kh: "kh" constant?
     kl: "kl" constant?
@@ -34,6 +39,30 @@ dice_grammar = r"""
     %ignore " "
 """
 
+# Building the LALR tables is far more expensive than parsing a formula, so do it only once.
+# The compiled tables are also cached on disk so later start-ups skip grammar analysis. The cache
+# is unpickled on load, so it lives next to this file rather than in the shared temp directory
+lark_cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.lark_cache.tmp')
+dice_parser = Lark(dice_grammar, parser='lalr', cache=lark_cache_path)
+
+# Formulas like "1d100" or "2d6", which most tables use, are rolled without the parser
+simple_dice_pattern = re.compile(r' *(\d+) *d *(\d+) *')
+
+def roll_dice(count, sides):
+    """
+    Rolls count dice with the given number of sides.
+
+    Returns:
+        list: The individual rolls, empty if count or sides is not positive.
+    """
+    if count <= 0 or sides <= 0:
+        return []
+    elif count == 1:
+        return [random.randint(1, sides)]
+    else:
+        # choices draws the whole pool in one C-level call instead of a randint per die
+        return random.choices(range(1, sides + 1), k=count)
+
 class DiceTransformer(Transformer):
 
     def __init__(self):
@@ -73,28 +102,21 @@ class DiceTransformer(Transformer):
 
     def dice(self, args):
         pool = args[0]
-        if len(args) == 2:
-            modifier = args[1]
-        else:
-            modifier = lambda x : x
-        return sum(modifier(pool))
+        modifiers = args[1] if len(args) == 2 else []
+        for modifier in modifiers:
+            pool = modifier(pool)
+        return sum(pool)
 
     def simpledice(self, args):
         count = args[0]
         sides = args[1]
 
-        if count <= 0 or sides <= 0:
-            result = []
-        else:
-            result = [random.randint(1, sides) for _ in range(count)]
+        result = roll_dice(count, sides)
         self.rolls[f"{count}d{sides}"] = result
         return result;
 
     def dicelist(self, args):
-        if len(args) == 1:
-            return args
-        else:
-            return [args[0], *args[1]]
+        return list(args)
 
     def dicepool(self, args):
         pool = args[0]
@@ -104,12 +126,8 @@ class DiceTransformer(Transformer):
         return int(args[0])
 
     def modifiers(self, args):
-        if len(args) == 0:
-            return lambda x : x
-        else:
-            f = args[0]
-            g = args[1]
-            return lambda x : g(f(x))
+        # Applied in order by dice(); modifiers without effect are None and skipped here
+        return [m for m in args if m is not None]
 
     def modifier(self, args):
         return args[0]
@@ -144,7 +162,7 @@ class DiceTransformer(Transformer):
     
     def min(self, args):
         if len(args) == 0:
-            return lambda x : x
+            return None
         minimum = args[0]
         def replace_min(x):
             return [minimum if i < minimum else i for i in x]
@@ -152,17 +170,18 @@ class DiceTransformer(Transformer):
 
     def max(self, args):
         if len(args) == 0:
-            return lambda x : x
+            return None
         maximum = args[0]
         def replace_max(x):
             return [maximum if i > maximum else i for i in x]
         return replace_max
 
+# Parse trees are never modified by the transformer, so the same formula can share one tree
+@functools.lru_cache(maxsize=512)
 def try_parse(formula):
-    parser = Lark(dice_grammar)
     tree = None
     try:
-        _tree = parser.parse(formula)
+        _tree = dice_parser.parse(formula)
     except Exception as e:
         # print(f"Error while parsing {formula}: {e}")
         pass
@@ -174,14 +193,47 @@ def try_parse(formula):
 def is_dice_formula(formula):
     return try_parse(formula) != None
 
+# Transformers are reused per thread, only the rolls dict is reset for every formula
+transformer_local = threading.local()
+
 def transform_formula(tree):
-    transformer = DiceTransformer()
+    transformer = getattr(transformer_local, 'transformer', None)
+    if transformer is None:
+        transformer = transformer_local.transformer = DiceTransformer()
+    transformer.rolls = {}
     result = transformer.transform(tree)
     return {
         "result": result, # integer result
         "rolls": transformer.rolls, # dice roll of simple dice formulas
     }
 
+@functools.lru_cache(maxsize=1024)
+def compile_formula(formula):
+    """
+    Prepares a dice formula for repeated rolling. The formula is parsed once; the returned
+    function only rolls the dice and evaluates the parsed tree. Plain "NdS" formulas skip
+    the parser entirely.
+
+    Args:
+        formula (str): The dice formula to compile.
+
+    Returns:
+        function: A function without arguments returning the same dictionary as roll_formula.
+    """
+    match = simple_dice_pattern.fullmatch(formula)
+    if match:
+        count, sides = int(match[1]), int(match[2])
+        key = f"{count}d{sides}"
+        def roll_simple():
+            rolls = roll_dice(count, sides)
+            return {"result": sum(rolls), "rolls": {key: rolls}}
+        return roll_simple
+
+    tree = try_parse(formula)
+    def roll():
+        return transform_formula(tree)
+    return roll
+
 def roll_formula(formula):
     """
     Parses and evaluates a dice formula.
@@ -192,8 +244,31 @@ def roll_formula(formula):
     Returns:
         dict: A dictionary containing the result of the roll and the individual rolls.
     """
-    tree = try_parse(formula)
-    return transform_formula(tree)
+    return compile_formula(formula)()
+
+def roll_many(formula, n):
+    """
+    Rolls a dice formula n times. For plain "NdS" formulas all the dice of all the rolls
+    are drawn in a single call.
+
+    Args:
+        formula (str): The dice formula to roll.
+        n (int): The number of rolls.
+
+    Returns:
+        list: The integer results of the n rolls.
+    """
+    match = simple_dice_pattern.fullmatch(formula)
+    if match:
+        count, sides = int(match[1]), int(match[2])
+        if count <= 0 or sides <= 0:
+            return [0] * n
+        pool = random.choices(range(1, sides + 1), k=count * n)
+        if count == 1:
+            return pool
+        return [sum(pool[i:i + count]) for i in range(0, len(pool), count)]
+    roll = compile_formula(formula)
+    return [roll()["result"] for _ in range(n)]
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Roll dice using a formula.")
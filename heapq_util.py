@@ -1,16 +1,17 @@
-import heapq
-
 def max_n(l, n):
     """
     Given a list of numbers a, and an integer b, return the b highest numbers in a.
     Example: max_n([1,2,3], 2)=[2,3]
+    The input list is left untouched. Dice pools are small, so sorting beats heap selection.
     """
-    heapq.heapify(l)
-    return heapq.nlargest(n, l)
+    if n <= 0:
+        return []
+    return sorted(l)[-n:]
 
 def min_n(l, n):
-    heapq.heapify(l)
-    return heapq.nsmallest(n, l)
+    if n <= 0:
+        return []
+    return sorted(l)[:n]
 
 if __name__ == '__main__':
     print(max_n([1, 2, 3], 4))
@@ -0,0 +1,38 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def load_json(file_path):
+    """
+    Loads a JSON file, using orjson when it is installed.
+
+    Args:
+        file_path (str): The path to the JSON file.
+
+    Returns:
+        The decoded JSON data.
+    """
+    with open(file_path, 'rb') as f:
+        content = f.read()
+    if orjson:
+        return orjson.loads(content)
+    return json.loads(content)
+
+def dump_json(data, file_path):
+    """
+    Saves data to a UTF-8 encoded JSON file indented by 2 spaces, using orjson when it is installed.
+
+    Args:
+        data: The data to save.
+        file_path (str): The path to the JSON file.
+    """
+    if orjson:
+        content = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    else:
+        # orjson only supports a 2-space indent, match it so the output does not depend on it
+        content = json.dumps(data, indent=2, ensure_ascii=False).encode('utf8')
+    with open(file_path, 'wb') as f:
+        f.write(content)
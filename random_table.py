@@ -1,12 +1,42 @@
-import json
+import bisect
 import csv
+import io
 import os
 import re
 from dice_roller import *
 from dice_util import guess_dice_formula
+from json_util import load_json, dump_json
 
-def flatten(xss):
-    return [x for xs in xss for x in xs]
+# [[...]] marks an inline roll or a link to another table in entry targets
+link_pattern = re.compile(r'\[\[(.*?)\]\]')
+markdown_pipe_pattern = re.compile(r'\|')
+# Roll range of a TSV row: "5", "5-7" or "5–7" (U+2013)
+range_pattern = re.compile(r'\s*(\d+)\s*(?:[-–]\s*(\d+)\s*)?$')
+
+# Largest roll span for which RandomTable keeps a direct roll -> entries list instead of bisecting
+DIRECT_INDEX_MAX_SPAN = 4096
+
+# Deepest chain of [[table]] links followed by one draw, links forming a cycle stop here
+MAX_LINK_DEPTH = 256
+
+# Tables loaded from disk, keyed by file path, as ((st_mtime_ns, st_size), RandomTable)
+table_cache = {}
+
+def quote_tsv_field(field):
+    """
+    Quotes a TSV field the same way csv.writer does with its default dialect, so that
+    csv.reader reads it back unchanged.
+
+    Args:
+        field (str): The field to quote.
+
+    Returns:
+        str: The field, wrapped in double quotes with inner quotes doubled if it contains
+        a tab, a double quote or a line break; otherwise the field unchanged.
+    """
+    if '"' in field or '\t' in field or '\n' in field or '\r' in field:
+        return '"' + field.replace('"', '""') + '"'
+    return field
 
 def replace_links_for_markdown(pattern):
     try:
@@ -18,9 +48,10 @@ def replace_links_for_markdown(pattern):
                 return f"`dice: [[{link}^table]]`"
         
         # Replace all occurrences of [[string]] with the result of roll_formula(string)
-        result = re.sub(r'\[\[(.*?)\]\]', replacer, pattern)
+        # Plain text (most entries) has no links, skip the regex for it
+        result = link_pattern.sub(replacer, pattern) if '[[' in pattern else pattern
         # Escape reserved char of Markdown: |
-        result = re.sub(r'\|', r"\|", result)
+        result = markdown_pipe_pattern.sub(r"\|", result)
         return result
     except Exception as e:
         print(f"Error replacing inline rolls: {e}")
@@ -42,13 +73,21 @@ class RandomTable:
 
     Methods:
         roll(): Rolls the dice and returns the result.
-        get_entry(roll_result): Finds the appropriate entry based on the roll result.
-        resolve_target(entry, tables=None): Resolves the target of an entry, handling text and document types.
+        build_entry_index(): Precomputes the roll lookup used by get_entry.
+        get_entry(roll_result): Finds the appropriate entries based on the roll result.
+        resolve_target(entry, tables=None, rolls=None): Resolves the target of an entry, appending the rolls of linked tables to rolls.
         draw(tables=None): Rolls on the table and resolves the target, returning a dictionary with results and rolls.
+        draw_into(out, tables=None): Rolls on the table and appends the resolved targets to out, returning the rolls.
+        draw_steps(roll_result): Generator resolving the entries of a roll, yielding the names of linked tables.
+        draw_many(n, tables=None): Draws n times from the table, returning a list of draw results.
         formatted_draw(tables=None): Returns a formatted string of the roll and resolved target.
         save_to_json(file_path): Saves the random table to a JSON file.
         save_to_tsv(file_path): Saves the random table to a TSV file.
     """
+    __slots__ = ('name', 'roll_formula', 'entries', 'displayRoll', 'replacement', '_roll_fn',
+                 '_segment_starts', '_segment_entries', '_entries_by_roll', '_lowest_roll',
+                 'file_path', 'mtime', 'file_stat')
+
     def __init__(self, name, roll_formula, entries, displayRoll=True, replacement=True, file_path=None, mtime=None):
         """
         Initializes a RandomTable object.
@@ -64,11 +103,24 @@ class RandomTable:
         self.displayRoll = displayRoll
         self.replacement = replacement
 
-        self.roll_results_stash = []
+        self._roll_fn = compile_formula(roll_formula)
+        self.build_entry_index()
 
         # For Manager Only
         self.file_path = file_path
         self.mtime = mtime
+        # (st_mtime_ns, st_size) of file_path when loaded, the key of the table cache
+        self.file_stat = None
+
+    def __getstate__(self):
+        # The compiled roll function is a closure and cannot be pickled (e.g. when tables are
+        # loaded in worker processes), it is compiled again from roll_formula on unpickling
+        return {slot: getattr(self, slot) for slot in self.__slots__ if slot != '_roll_fn' and hasattr(self, slot)}
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+        self._roll_fn = compile_formula(self.roll_formula)
 
     def roll(self):
         """
@@ -77,68 +129,122 @@ class RandomTable:
         Returns:
             int: The result of the dice roll.
         """
-        return roll_formula(self.roll_formula)["result"]
+        return self._roll_fn()["result"]
+
+    def build_entry_index(self):
+        """
+        Splits the roll range at every entry boundary and records the entries covering each segment,
+        in table order, so that get_entry is a binary search. Entries may overlap (e.g. a name table
+        where one entry gives the surname for every roll), so a segment can hold several entries.
+        Must be called again if self.entries is modified.
+        """
+        bounds = sorted({e.min_roll for e in self.entries} | {e.max_roll + 1 for e in self.entries})
+        covering = [[] for _ in bounds]
+        for e in self.entries:
+            for i in range(bisect.bisect_left(bounds, e.min_roll), bisect.bisect_left(bounds, e.max_roll + 1)):
+                covering[i].append(e)
+        self._segment_starts = bounds
+        self._segment_entries = [tuple(c) for c in covering]
+
+        # Typical tables (1d20, 1d100, ...) span few rolls, there a list indexed by roll replaces the search
+        self._entries_by_roll = None
+        if bounds and bounds[-1] - bounds[0] <= DIRECT_INDEX_MAX_SPAN:
+            self._lowest_roll = bounds[0]
+            by_roll = []
+            for start, end, entries in zip(bounds, bounds[1:], self._segment_entries):
+                by_roll.extend([entries] * (end - start))
+            self._entries_by_roll = by_roll
 
     def get_entry(self, roll_result):
         """
-        Finds the appropriate entry based on the roll result.
+        Finds the appropriate entries based on the roll result.
 
         Args:
             roll_result (int): The result of the dice roll.
 
         Returns:
-            Entry: The matching Entry object, or None if no match is found.
+            tuple: The matching Entry objects in table order, empty if no match is found.
         """
-        return filter(lambda e: e.min_roll <= roll_result <= e.max_roll, self.entries)
-
-    def replace_links_with_draw_results(self, pattern, tables=None):
-        def replacer(match):
-            rep_string = match.group(1)
-            tree = try_parse(rep_string)
-            if tree:
-                # dice formula
-                result = transform_formula(tree)
-                return str(result["result"])
+        if self._entries_by_roll is not None:
+            i = roll_result - self._lowest_roll
+            if 0 <= i < len(self._entries_by_roll):
+                return self._entries_by_roll[i]
+            return ()
+        i = bisect.bisect_right(self._segment_starts, roll_result) - 1
+        if i < 0:
+            return ()
+        return self._segment_entries[i]
+
+    def document_steps(self, entry):
+        return (yield entry.target[2:-2])
+
+    def template_steps(self, entry):
+        texts, links = entry.template
+        out = [texts[0]]
+        for (link, is_dice), text in zip(links, texts[1:]):
+            if is_dice:
+                # dice formula, compiled once per distinct formula
+                out.append(str(compile_formula(link)()["result"]))
             else:
-                # Not a dice formula, regarded as a table
-                if tables and rep_string in tables:
-                    #Recursively roll the linked table by name
-                    linked_table = tables[rep_string]
-                    linked_result = linked_table.draw(tables)
-                    self.roll_results_stash += linked_result['roll']
-                    return ' '.join(linked_result['result'])
-                else:
-                    print(f"Warning: No table named {rep_string} found, regarded as plain text")
-                    return rep_string
-        
-        # Replace all occurrences of [[string]] with the result of roll_formula(string)
-        return re.sub(r'\[\[(.*?)\]\]', replacer, pattern)
+                out.append((yield link))
+            out.append(text)
+        return ''.join(out)
+
+    # Entry.type -> resolver for entries that are not plain text, the type is classified once when
+    # the Entry is created. Resolvers are generators run by run_draw_steps: they yield the name of
+    # each table they link to, receive its drawn text, and return the resolved target.
+    resolvers = {
+        "document": document_steps,
+        "template": template_steps,
+    }
+
+    def draw_steps(self, roll_result):
+        """
+        Generator resolving the entries for roll_result, run by run_draw_steps.
+        Yields the names of linked tables and returns the list of resolved targets.
+        """
+        out = []
+        for entry in self.get_entry(roll_result):
+            if entry.type == "text":
+                out.append(entry.target)
+            else:
+                out.append((yield from self.resolvers[entry.type](self, entry)))
+        return out
 
-    def resolve_target(self, entry, tables=None):
+    def resolve_target(self, entry, tables=None, rolls=None):
         """
         Resolves the target of an entry.  If the target is a string, it returns the string.
         If the target is a link to another table, it rolls that table and returns the result.
+        Inline rolls and links embedded in the text are replaced by their results.
 
         Args:
             entry (Entry): The entry to resolve.
             tables (dict, optional): A dictionary of RandomTable objects, used for resolving table links. Defaults to None.
+            rolls (list, optional): Receives the rolls made on linked tables. Defaults to None.
 
         Returns:
             str: The resolved target.
         """
-        return self.replace_links_with_draw_results(entry.target, tables)
-        # match entry.type:
-        #     case "text":
-        #         return [replace_inline_rolls(entry.target)]
-        #     case "document":
-        #         if tables and entry.target in tables:
-        #             #Recursively roll the linked table by name
-        #             linked_table = tables[entry.target]
-        #             linked_result = linked_table.draw(tables)
-        #             self.roll_results_stash += linked_result['roll']
-        #             return linked_result['result']
-        # print(f"Warning: Cann't resolve target for {entry}")
-        # return []
+        if entry.type == "text":
+            return entry.target
+        return run_draw_steps(self.resolvers[entry.type](self, entry), tables, [] if rolls is None else rolls)
+
+    def draw_into(self, out, tables=None):
+        """
+        Rolls on the table and appends the resolved targets to out.
+        Linked tables are drawn in a loop rather than by recursion, see run_draw_steps.
+
+        Args:
+            out (list): The list receiving the resolved targets.
+            tables (dict, optional): A dictionary of RandomTable objects, used for resolving table links. Defaults to None.
+
+        Returns:
+            list: The rolls made, starting with the roll on this table followed by those of linked tables.
+        """
+        roll_result = self.roll()
+        rolls = [roll_result]
+        out.extend(run_draw_steps(self.draw_steps(roll_result), tables, rolls))
+        return rolls
 
     def draw(self, tables=None):
         """
@@ -148,19 +254,50 @@ class RandomTable:
             tables (dict, optional): A dictionary of RandomTable objects, used for resolving table links. Defaults to None.
 
         Returns:
-            str: The resolved target.
+            dict: The resolved targets under 'result' and the rolls made under 'roll'.
         """
-        roll_result = self.roll()
-        self.roll_results_stash = [roll_result]
-        entries = self.get_entry(roll_result)
+        result = []
+        rolls = self.draw_into(result, tables)
         return {
-            'result': [self.resolve_target(entry, tables) for entry in entries],
-            'roll': self.roll_results_stash
+            'result': result,
+            'roll': rolls
         }
 
+    def draw_many(self, n, tables=None):
+        """
+        Draws n times from the table, e.g. to generate a batch of encounters.
+
+        Args:
+            n (int): The number of draws.
+            tables (dict, optional): A dictionary of RandomTable objects, used for resolving table links. Defaults to None.
+
+        Returns:
+            list: n dictionaries, each as returned by draw.
+        """
+        get_entry = self.get_entry
+        # Targets of rolls whose entries are all plain text, keyed by the id of the entries tuple
+        # from the index; such rolls skip the resolver machinery entirely
+        plain_targets = {}
+        draws = []
+        # All n rolls on this table are made up front, see roll_many
+        for roll_result in roll_many(self.roll_formula, n):
+            entries = get_entry(roll_result)
+            key = id(entries)
+            if key not in plain_targets:
+                plain_targets[key] = [e.target for e in entries] if all(e.type == "text" for e in entries) else None
+            targets = plain_targets[key]
+            if targets is not None:
+                draws.append({'result': list(targets), 'roll': [roll_result]})
+            else:
+                rolls = [roll_result]
+                result = run_draw_steps(self.draw_steps(roll_result), tables, rolls)
+                draws.append({'result': result, 'roll': rolls})
+        return draws
+
     def formatted_draw(self, tables=None):
-        result = self.draw(tables)
-        return f"{result['roll']} : {' '.join(result['result'])}"
+        out = []
+        rolls = self.draw_into(out, tables)
+        return f"{rolls} : {' '.join(out)}"
 
     def __repr__(self):
         return f"RandomTable(name='{self.name}', roll_formula='{self.roll_formula}', entries={self.entries})"
@@ -198,8 +335,7 @@ class RandomTable:
                prepare_entry(e) for e in self.entries
             ]
         }
-        with open(file_path, 'w', encoding="utf8") as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
+        dump_json(data, file_path)
 
     def save_to_tsv(self, file_path):
         """
@@ -209,14 +345,16 @@ class RandomTable:
         Args:
             file_path (str): The path to the TSV file.
         """
-        with open(file_path, 'w') as f:
-            writer = csv.writer(f, delimiter='\t')
-            # Write header
-            writer.writerow([self.roll_formula, self.name])
-            for entry in self.entries:
-                range_str = f"{entry.min_roll}-{entry.max_roll}" if entry.min_roll != entry.max_roll else f"{entry.min_roll}"
-                target_str = entry.target
-                writer.writerow([range_str, target_str])
+        # Rows are joined by hand instead of going through csv.writer; quoting and the
+        # '\r\n' terminator match what csv.writer used to emit.
+        # Header
+        lines = [f"{quote_tsv_field(self.roll_formula)}\t{quote_tsv_field(self.name)}"]
+        for entry in self.entries:
+            range_str = f"{entry.min_roll}-{entry.max_roll}" if entry.min_roll != entry.max_roll else f"{entry.min_roll}"
+            lines.append(f"{range_str}\t{quote_tsv_field(entry.target)}")
+        lines.append('')
+        with open(file_path, 'w', newline='') as f:
+            f.write('\r\n'.join(lines))
 
     def save_to_markdown(self, file_path):
         """
@@ -231,30 +369,99 @@ class RandomTable:
         from datetime import datetime
     
         # Add YAML frontmatter
-        markdown = f"""---
+        parts = [f"""---
 date: {datetime.now().strftime('%Y-%m-%d')}
 tags: 
     - table
 ---
-"""
+"""]
     
-        markdown += f"# {self.name}\n\n"
-        markdown += f"`dice: [[{self.name}^table]]`\n\n"
-        markdown += f"| dice: {self.roll_formula}  | {self.name} |\n"
-        markdown += "| ---------- | ------- |\n"
+        parts.append(f"# {self.name}\n\n")
+        parts.append(f"`dice: [[{self.name}^table]]`\n\n")
+        parts.append(f"| dice: {self.roll_formula}  | {self.name} |\n")
+        parts.append("| ---------- | ------- |\n")
     
         for entry in self.entries:
             dice_range = f"{entry.min_roll}-{entry.max_roll}" if entry.min_roll != entry.max_roll else str(entry.min_roll)
             target = replace_links_for_markdown(entry.target)
-            markdown += f"| {dice_range} | {target} |\n"
+            parts.append(f"| {dice_range} | {target} |\n")
     
-        markdown += "^table\n"
+        parts.append("^table\n")
+        # Join once instead of growing a string with += for every row
+        markdown = ''.join(parts)
     
         with open(file_path, 'w') as file:
             file.write(markdown)
         return markdown
 
+def run_draw_steps(steps, tables, rolls):
+    """
+    Runs a resolver generator to completion, drawing the tables it links to. Nested links are
+    handled with an explicit stack of generators instead of recursive draw calls; a RecursionError
+    is raised when links nest deeper than MAX_LINK_DEPTH, e.g. a table linking to itself.
+
+    Args:
+        steps (generator): The generator to run, e.g. from RandomTable.draw_steps.
+        tables (dict): A dictionary of RandomTable objects, used for resolving table links.
+        rolls (list): Receives the rolls made on linked tables, in the order they are drawn.
+
+    Returns:
+        The value returned by steps.
+    """
+    stack = [steps]
+    value = None
+    while True:
+        try:
+            name = stack[-1].send(value)
+        except StopIteration as done:
+            stack.pop()
+            if not stack:
+                return done.value
+            # A linked table finished drawing, hand its text to the generator that linked it
+            value = ' '.join(done.value)
+            continue
+        if tables and name in tables:
+            if len(stack) > MAX_LINK_DEPTH:
+                raise RecursionError(f"Table links nested deeper than {MAX_LINK_DEPTH} levels, drawing {name}")
+            linked_table = tables[name]
+            roll_result = linked_table.roll()
+            rolls.append(roll_result)
+            stack.append(linked_table.draw_steps(roll_result))
+            value = None
+        else:
+            print(f"Warning: No table named {name} found, regarded as plain text")
+            value = name
+
+def classify_target(target):
+    """
+    Classifies the target of an entry, which decides how RandomTable.resolve_target handles it.
+
+    Returns:
+        str: "text" if the target has no [[...]] and is used as is, "document" if it is a single
+        link to another table, "template" if it contains inline rolls or links mixed with text.
+    """
+    links = list(link_pattern.finditer(target))
+    if not links:
+        return "text"
+    if len(links) == 1 and links[0].span() == (0, len(target)) and not is_dice_formula(links[0].group(1)):
+        return "document"
+    return "template"
+
+def split_template(target):
+    """
+    Splits a target at its [[...]] links, so that it can be resolved without matching the pattern again.
+
+    Returns:
+        tuple: The texts around the links (one more than there are links), and for each link
+        its content together with whether it is a dice formula.
+    """
+    parts = link_pattern.split(target)
+    links = [(link, is_dice_formula(link)) for link in parts[1::2]]
+    return parts[0::2], links
+
 class Entry:
+    __slots__ = ('min_roll', 'max_roll', 'target', 'type', 'template')
+
     def __init__(self, min_roll, max_roll, target):
         """
         Initializes an Entry object.
@@ -271,7 +478,8 @@ class Entry:
         self.min_roll = min_roll
         self.max_roll = max_roll
         self.target = target
-        # self.type = type
+        self.type = classify_target(target)
+        self.template = split_template(target) if self.type == "template" else None
 
     def __repr__(self):
          return f"Entry: {self.min_roll}-{self.max_roll} '{self.target}'"
@@ -303,13 +511,58 @@ def load_random_table_from_json_file(file_path):
     Returns:
         RandomTable: A RandomTable object.
     """
-    with open(file_path, 'r') as f:
-        data = json.load(f)
-        return load_random_table_from_json(data)
+    def parse():
+        return load_random_table_from_json(load_json(file_path))
+    return load_cached_table(file_path, parse)
 
 def load_random_table_from_tsv_file(file_path):
-    with open(file_path, 'r') as f:
-        return load_random_table_from_tsv(f)
+    def parse():
+        # newline='' lets csv.reader handle line breaks inside quoted fields
+        with open(file_path, 'r', newline='') as f:
+            return load_random_table_from_tsv(f)
+    return load_cached_table(file_path, parse)
+
+def load_cached_table(file_path, parse):
+    """
+    Returns the table previously loaded from file_path if the file has not been modified
+    since, otherwise calls parse() and caches its result keyed by the file's mtime and size.
+
+    Args:
+        file_path (str): The path to the table file.
+        parse (callable): Loads the table from file_path when the cache is stale.
+
+    Returns:
+        RandomTable: A RandomTable object, shared between loads of an unchanged file.
+    """
+    st = os.stat(file_path)
+    file_stat = (st.st_mtime_ns, st.st_size)
+    cached = table_cache.get(file_path)
+    if cached and cached[0] == file_stat:
+        return cached[1]
+    random_table = parse()
+    random_table.file_path = file_path
+    random_table.mtime = st.st_mtime
+    random_table.file_stat = file_stat
+    cache_table(random_table)
+    return random_table
+
+def cache_table(random_table):
+    """
+    Stores a table loaded from random_table.file_path in the table cache, e.g. one loaded in
+    another process, whose cache does not carry over to this one.
+    """
+    table_cache[random_table.file_path] = (random_table.file_stat, random_table)
+
+def get_cached_table(file_path):
+    """
+    Returns the cached table of file_path if the file has not been modified since it was loaded, otherwise None.
+    """
+    cached = table_cache.get(file_path)
+    if cached:
+        st = os.stat(file_path)
+        if cached[0] == (st.st_mtime_ns, st.st_size):
+            return cached[1]
+    return None
 
 def load_random_table_from_tsv(src):
     """
@@ -321,25 +574,21 @@ def load_random_table_from_tsv(src):
     Returns:
         RandomTable: A RandomTable object.
     """
-    data = src.split('\n') if isinstance(src, str) else src
+    data = io.StringIO(src) if isinstance(src, str) else src
     reader = csv.reader(data, delimiter='\t')
     header = next(reader)
 
     roll_formula, name = header
-    max_roll_target = []
-    min_roll_target = []
 
     entries = []
     for row in reader:
         try:
             range_str = row[0]
-            range_str = re.sub(r'–', '-', range_str) # U+2013
-            if '-' in range_str:
-                min_roll, max_roll = map(int, range_str.split('-'))
-            else:
-                min_roll = max_roll = int(range_str)
-            max_roll_target.append(max_roll)
-            min_roll_target.append(min_roll)
+            match = range_pattern.match(range_str)
+            if match is None:
+                raise ValueError(f"invalid range '{range_str}'")
+            min_roll = int(match.group(1))
+            max_roll = int(match.group(2)) if match.group(2) else min_roll
 
             target = row[1]
             # entry_type = "document" if target.startswith("[[") and target.endswith("]]") else "text"
@@ -354,7 +603,8 @@ def load_random_table_from_tsv(src):
         raise ValueError("TSV file is empty or contains no valid data.")
 
     if roll_formula.strip() == "":
-        roll_formula = guess_dice_formula(min(min_roll_target), max(max_roll_target)) 
+        # Only tables without a formula need the roll bounds, compute them here instead of while parsing
+        roll_formula = guess_dice_formula(min(e.min_roll for e in entries), max(e.max_roll for e in entries))
     if name.strip() == "":
         name = "Random Table" 
     return RandomTable(name, roll_formula, entries)
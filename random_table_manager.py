@@ -1,36 +1,80 @@
 import os
-import json
 import argparse
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
 from random_table import *
+from json_util import load_json, dump_json
 
-def find_data_files(directory):
+# Extensions of the table files RandomTableManager loads
+DATA_FILE_EXTENSIONS = ('.json', '.tsv', '.txt')
+
+def find_data_files(directory, exts=DATA_FILE_EXTENSIONS):
+    # Same order as os.walk: the files of a directory, then each subdirectory in turn.
+    # DirEntry caches the file type, so no extra stat is needed per entry
     data_files = []
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if os.path.splitext(file)[1] in ('.json', '.tsv', '.txt'):
-                data_files.append(os.path.join(root, file))
+    stack = [directory]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                subdirs = []
+                for entry in it:
+                    if entry.is_dir():
+                        # Like os.walk, symlinked directories are not followed
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                    elif entry.name.endswith(exts):
+                        data_files.append(entry.path)
+        except OSError:
+            continue
+        stack.extend(reversed(subdirs))
     return data_files
 
+def load_data_file(data_file):
+    """
+    Loads a random table from a JSON or TSV data file. Runs in worker processes when
+    RandomTableManager loads in parallel, so errors are returned rather than raised.
+
+    Args:
+        data_file (str): The path to the data file.
+
+    Returns:
+        tuple: (RandomTable, None) on success, (None, message) if the file is skipped.
+    """
+    try:
+        if data_file.endswith('.json'):
+            return load_random_table_from_json_file(data_file), None
+        elif data_file.endswith(('.tsv', '.txt')):
+            return load_random_table_from_tsv_file(data_file), None
+    except Exception as e:
+        return None, f"Error loading {data_file}, Skipping: {e}"
+    return None, f"Unsupported file type: {data_file}, Skipping"
+
 def load_metadata(out_dir):
     metadata_path = os.path.join(out_dir, 'metadata.json')
     if os.path.exists(metadata_path):
-        with open(metadata_path, 'r') as f:
-            return json.load(f)
+        return load_json(metadata_path)
     return {}
 
 def save_metadata(out_dir, metadata):
     metadata_path = os.path.join(out_dir, 'metadata.json')
-    with open(metadata_path, 'w') as f:
-        json.dump(metadata, f, indent=4, ensure_ascii=False)
+    dump_json(metadata, metadata_path)
 
 class RandomTableManager:
 
-    def __init__(self, directory):
+    def __init__(self, directory, processes=None):
         self.tables = {}
         self.directory = directory
         # self.original_path = {}
+        # Data file and output subdirectory in exports of each table, kept here rather than on
+        # the tables because loaded tables are shared between managers (see load_cached_table)
+        self.table_files = {}
+        self.relative_dirs = {}
+        # Export metadata by absolute output directory, only kept inside exporting()
+        self.metadata_cache = {}
+        self.unsaved_metadata = set()
+        self.defer_metadata = False
 
-        self.load(directory)
+        self.load(directory, processes)
 
     def add_table_json(self, data):
         table = load_random_table_from_json(data)
@@ -46,84 +90,143 @@ class RandomTableManager:
         path = os.path.join(self.directory, table.name+".tsv")
         table.save_to_tsv(path)
    
-    def load(self, directory):
+    def load(self, directory, processes=None):
+        """
+        Loads every table file found under directory.
+
+        Args:
+            directory (str): The directory to search for data files.
+            processes (int, optional): Parse the files in this many worker processes. Starting the
+                workers costs more than parsing a few hundred small tables, so by default files are
+                loaded serially in this process. Files unchanged since they were last loaded are
+                taken from the table cache either way.
+        """
         data_files = find_data_files(directory)
-        for data_file in data_files:
-            # print(f"Processing {data_file}...")
-            try:
-                (root ,ext) = os.path.splitext(data_file)
-                if ext == '.json':
-                    random_table = load_random_table_from_json_file(data_file)
-                elif ext in ('.tsv', '.txt'):
-                    random_table = load_random_table_from_tsv_file(data_file)
+        if processes and processes > 1 and len(data_files) > 1:
+            results = [None] * len(data_files)
+            to_parse = []
+            for i, data_file in enumerate(data_files):
+                try:
+                    cached = get_cached_table(data_file)
+                except OSError:
+                    cached = None
+                if cached is not None:
+                    results[i] = (cached, None)
                 else:
-                    print(f"Unsupported file type: {data_file}, Skipping")
-                    continue
-            except Exception as e:
-                print(f"Error loading {data_file}, Skipping: {e}")
+                    to_parse.append(i)
+            if to_parse:
+                with ProcessPoolExecutor(max_workers=processes) as executor:
+                    parsed = executor.map(load_data_file, [data_files[i] for i in to_parse], chunksize=16)
+                    for i, (random_table, error) in zip(to_parse, parsed):
+                        # The workers' table caches are lost with them, keep the results in this process's
+                        if random_table is not None:
+                            cache_table(random_table)
+                        results[i] = (random_table, error)
+        else:
+            results = map(load_data_file, data_files)
+        for data_file, (random_table, error) in zip(data_files, results):
+            # print(f"Processing {data_file}...")
+            if error:
+                print(error)
             else:
                 if random_table.name in self.tables:
                     print(f"Warning: Duplicate Table Names {random_table.name}, Overwritten")
-                random_table.data_file = data_file
-                random_table.mtime = os.path.getmtime(data_file)
+                self.table_files[random_table.name] = data_file
+                # mtime is set by the loader; the table's subdirectory in exports is computed once here
+                self.relative_dirs[random_table.name] = os.path.relpath(os.path.dirname(data_file), start=self.directory)
                 self.tables[random_table.name] = random_table
                 # self.original_path[random_table.name] = data_file
 
-    def export_to_json(self, directory):
-        metadata = load_metadata(directory)
-        new_metadata = {}
-        for table_name, table in self.tables.items():
-            original_path = table.data_file
-            last_modified = table.mtime
-            if table_name not in metadata or metadata[table_name] < last_modified:
-                relative_dir = os.path.relpath(os.path.dirname(original_path), start=self.directory)
-                path = os.path.join(directory, relative_dir, f"{table_name}.json")
-                os.makedirs(os.path.dirname(path), exist_ok=True)
-                table.save_to_json(path)
-                new_metadata[table_name] = last_modified
+    def get_metadata(self, directory):
+        """
+        Returns the export metadata of directory. Outside exporting() its metadata.json is read on
+        every call, so deleted or replaced exports are noticed; inside the block it is read once.
+        """
+        if not self.defer_metadata:
+            return load_metadata(directory)
+        key = os.path.abspath(directory)
+        if key not in self.metadata_cache:
+            self.metadata_cache[key] = load_metadata(directory)
+        return self.metadata_cache[key]
+
+    def export_tables(self, directory, extension, save):
+        """
+        Exports the tables modified since the last export to directory, keeping the layout of the data files.
+
+        Args:
+            directory (str): The output directory.
+            extension (str): The extension of the exported files, e.g. ".json".
+            save (callable): Writes a table to a path, e.g. RandomTable.save_to_json.
+        """
+        metadata = self.get_metadata(directory)
+        # Only tables modified since the last export are written, up to date ones cost a dict lookup
+        stale = [(table_name, table) for table_name, table in self.tables.items()
+                 if table_name not in metadata or metadata[table_name] < table.mtime]
+
+        exported = {}
+        created_dirs = set()
+        try:
+            for table_name, table in stale:
+                out_dir = os.path.join(directory, self.relative_dirs[table_name])
+                if out_dir not in created_dirs:
+                    os.makedirs(out_dir, exist_ok=True)
+                    created_dirs.add(out_dir)
+                save(table, os.path.join(out_dir, f"{table_name}{extension}"))
+                exported[table_name] = table.mtime
+        finally:
+            # Saved even if a table failed to export, tables not reached keep their old entry and stay stale
+            new_metadata = {}
+            for table_name in self.tables:
+                if table_name in exported:
+                    new_metadata[table_name] = exported[table_name]
+                elif table_name in metadata:
+                    new_metadata[table_name] = metadata[table_name]
+            if self.defer_metadata:
+                key = os.path.abspath(directory)
+                self.metadata_cache[key] = new_metadata
+                self.unsaved_metadata.add(key)
             else:
-                new_metadata[table_name] = metadata[table_name]
-        
-        save_metadata(directory, new_metadata)
-    
+                save_metadata(directory, new_metadata)
+
+    def export_to_json(self, directory):
+        self.export_tables(directory, ".json", RandomTable.save_to_json)
+
     def export_to_tsv(self, directory):
-        metadata = load_metadata(directory)
-        new_metadata = {}
-        for table_name, table in self.tables.items():
-            original_path = table.data_file
-            last_modified = table.mtime
-            if table_name not in metadata or metadata[table_name] < last_modified:
-                relative_dir = os.path.relpath(os.path.dirname(original_path), start=self.directory)
-                path = os.path.join(directory, relative_dir, f"{table_name}.tsv")
-                os.makedirs(os.path.dirname(path), exist_ok=True)
-                table.save_to_tsv(path)
-                new_metadata[table_name] = last_modified
-            else:
-                new_metadata[table_name] = metadata[table_name]
-        
-        save_metadata(directory, new_metadata)
- 
+        self.export_tables(directory, ".tsv", RandomTable.save_to_tsv)
+
     def export_to_markdown(self, directory):
-        metadata = load_metadata(directory)
-        new_metadata = {}
-        for table_name, table in self.tables.items():
-            original_path = table.data_file
-            last_modified = table.mtime
-            if table_name not in metadata or metadata[table_name] < last_modified:
-                relative_dir = os.path.relpath(os.path.dirname(original_path), start=self.directory)
-                path = os.path.join(directory, relative_dir, f"{table_name}.md")
-                os.makedirs(os.path.dirname(path), exist_ok=True)
-                table.save_to_markdown(path)
-                new_metadata[table_name] = last_modified
-            else:
-                new_metadata[table_name] = metadata[table_name]
-        
-        save_metadata(directory, new_metadata)
+        self.export_tables(directory, ".md", RandomTable.save_to_markdown)
+
+    @contextlib.contextmanager
+    def exporting(self):
+        """
+        Batches the metadata writes of the exports made inside the block: each metadata.json is
+        written once when the block exits instead of after every export_to_* call.
+        """
+        self.defer_metadata = True
+        try:
+            yield self
+        finally:
+            self.defer_metadata = False
+            self.flush_metadata()
+
+    def flush_metadata(self):
+        """
+        Writes the metadata of exports deferred by exporting() and forgets the cached metadata.
+        """
+        for directory in self.unsaved_metadata:
+            save_metadata(directory, self.metadata_cache[directory])
+        self.unsaved_metadata.clear()
+        self.metadata_cache.clear()
 
     def draw(self, name):
         table = self.tables[name]
         return table.draw(self.tables)
 
+    def draw_many(self, name, n):
+        table = self.tables[name]
+        return table.draw_many(n, self.tables)
+
     def formatted_draw(self, name):
         table = self.tables[name]
         return table.formatted_draw(self.tables)
@@ -134,8 +237,9 @@ class RandomTableManager:
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='convert json files to random tables.')
     parser.add_argument('directory', type=str, nargs='?', default='tables', help='the directory containing json files (default: tables)')
+    parser.add_argument('--processes', type=int, default=None, help='parse the data files in this many worker processes')
     args = parser.parse_args()
-    manager = RandomTableManager(args.directory)
+    manager = RandomTableManager(args.directory, args.processes)
 
     print(manager.formatted_draw("WWN Wilderness Tags"))
     print(manager.formatted_draw("WWN Wilderness Tags"))
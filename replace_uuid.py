@@ -2,22 +2,33 @@
 import sys
 import re
 import os
+import mmap
+from concurrent.futures import ThreadPoolExecutor
+
+# @UUID[...]{label} references left in tables exported from FVTT, replaced by their label.
+# Matched on the raw UTF-8 bytes: ']' and '}' never occur inside a multi-byte character
+uuid_pattern = re.compile(rb'@UUID\[[^\]]+\]\{([^}]+)\}')
 
 def replace_uuid_in_file(file_path):
-    # Define the pattern and replacement string
-    pattern = r'@UUID\[[^\]]+\]\{([^}]+)\}'
-    replacement = r'\1'
+    # Define the replacement string
+    replacement = rb'\1'
 
     try:
-        # Read the content of the file
-        with open(file_path, 'r', encoding='utf-8') as file:
-            content = file.read()
-
-        # Replace all occurrences of the pattern
-        modified_content = re.sub(pattern, replacement, content)
-
-        # Write the modified content back to the original file
-        with open(file_path, 'w', encoding='utf-8') as file:
+        # Map the file instead of reading it into a string; files without any reference
+        # are left untouched so that their mtime (used by the table manager's export metadata) is kept
+        count = 0
+        with open(file_path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size > 0:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                    if content.find(b'@UUID[') != -1:
+                        modified_content, count = uuid_pattern.subn(replacement, content)
+        if count == 0:
+            print(f"No replacements needed in {file_path}")
+            return
+
+        # Write the modified content back into the original file once the map is closed, so
+        # symlinks, hard links, ownership and permissions are all kept
+        with open(file_path, 'wb') as file:
             file.write(modified_content)
 
         print(f"Replacements made in {file_path}")
@@ -30,10 +41,14 @@ def replace_uuid_in_file(file_path):
 # 删除从FVTT导出的随机表中的引用
 
 def process_directory(directory):
+    paths = []
     for root, _, files in os.walk(directory):
         for file_name in files:
-            full_path = os.path.join(root, file_name)
-            replace_uuid_in_file(full_path)
+            paths.append(os.path.join(root, file_name))
+    # Each file is read, substituted and written independently; the work is mostly
+    # file I/O, so threads overlap it despite the GIL
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 8) as executor:
+        list(executor.map(replace_uuid_in_file, paths))
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
@@ -0,0 +1,11 @@
+#! python3
+# Production entry point, app.py's app.run() is only meant for development:
+#   gunicorn -k gevent -w 9 -b 0.0.0.0:5000 wsgi:app
+# Requires gunicorn and gevent. Every worker loads its own RandomTableManager, so a table added
+# through /addTable is only visible to the other workers after they /load it from disk.
+
+# Patch the standard library before anything else is imported, so blocking IO yields to other greenlets
+from gevent import monkey
+monkey.patch_all()
+
+from app import app